@@ -1,13 +1,22 @@
 import streamlit as st
 from datetime import date
 from calendar import monthrange
+from functools import lru_cache
 import pandas as pd
 import altair as alt
-from sqlalchemy import create_engine, text
-import sqlalchemy.exc
+from sqlalchemy import create_engine, text, table, column, insert
 
 # Database setup
-eng = create_engine(st.secrets["db"]["url"], pool_pre_ping=True)
+@st.cache_resource(show_spinner=False)
+def get_engine():
+    return create_engine(
+        st.secrets["db"]["url"], pool_pre_ping=True,
+        pool_recycle=1800,
+        connect_args={"keepalives": 1, "keepalives_idle": 30,
+                      "keepalives_interval": 10, "keepalives_count": 5},
+    )
+
+eng = get_engine()
 
 # Ensure tables exist
 DDL = """
@@ -28,27 +37,36 @@ CREATE TABLE IF NOT EXISTS orcamento (
   valor_planejado NUMERIC,
   UNIQUE (username, mes, ano)
 );
+CREATE INDEX IF NOT EXISTS gastos_user_data ON gastos (username, data);
 """
-with eng.begin() as conn:
-    for stmt in DDL.split(";"):
-        stmt = stmt.strip()
-        if not stmt:
-            continue
-        try:
-            conn.exec_driver_sql(stmt)
-        except sqlalchemy.exc.IntegrityError as e:
-            if "already exists" in str(e).lower():
-                pass
-            else:
-                raise
+@st.cache_resource(show_spinner=False)
+def ensure_schema():
+    with eng.begin() as conn:
+        conn.exec_driver_sql(DDL)
+
+ensure_schema()
 
 # Utils
+@lru_cache(maxsize=4096)
+def _last_day(y, m):
+    return monthrange(y, m)[1]
+
+@lru_cache(maxsize=4096)
+def month_bounds(y, m):
+    return date(y, m, 1), date(y, m, _last_day(y, m))
+
 def add_months(d, n):
-    y, m = divmod(d.month - 1 + n, 12); y += d.year; m += 1
-    return date(y, m, min(d.day, monthrange(y, m)[1]))
+    total = d.month - 1 + n
+    y, m = d.year + total // 12, total % 12 + 1
+    return date(y, m, min(d.day, _last_day(y, m)))
+
+_TR = str.maketrans({",": ".", ".": ","})
 
 def brl(v):
-    return "R$ " + f"{v:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
+    return f"R$ {v:,.2f}".translate(_TR)
+
+def brl_series(s):
+    return "R$ " + s.map(lambda v: format(v, ",.2f")).str.translate(_TR)
 
 def rerun():
     return (st.rerun if hasattr(st, "rerun") else st.experimental_rerun)()
@@ -70,27 +88,55 @@ with st.sidebar:
     st.markdown("---")
 
 # Data helpers
+def month_range(u, m, a):
+    first = date(a, m, 1)
+    return dict(u=u, f=first, n=add_months(first, 1))
+
+@st.cache_data(ttl=60)
+def month_slice(u, m, a):
+    params = month_range(u, m, a)
+    with eng.connect() as c:
+        sel = pd.read_sql(text(
+            "SELECT id,data,valor,descricao,categoria,fonte FROM gastos "
+            "WHERE username=:u AND data>=:f AND data<:n "
+            "ORDER BY data DESC, id DESC"
+        ), c, params=params, parse_dates=["data"],
+           dtype={"id": "int64", "valor": "float64",
+                  "categoria": "category", "fonte": "category"})
+        agg = pd.read_sql(text(
+            "SELECT categoria, fonte, GROUPING(categoria) AS gc, GROUPING(fonte) AS gf, "
+            "COALESCE(ROUND(SUM(valor)*100), 0)::bigint AS valor_cents "
+            "FROM gastos WHERE username=:u AND data>=:f AND data<:n "
+            "GROUP BY GROUPING SETS ((categoria),(fonte),())"
+        ), c, params=params, dtype={"gc": "int64", "gf": "int64", "valor_cents": "int64"})
+    return sel, agg
+
 @st.cache_data(ttl=60)
-def load_table(name):
-    return pd.read_sql(text(f"SELECT * FROM {name}"), eng)
+def load_orc(u, m, a):
+    with eng.connect() as c:
+        v = c.execute(text(
+            "SELECT valor_planejado FROM orcamento WHERE username=:u AND mes=:m AND ano=:a LIMIT 1"
+        ), dict(u=u, m=m, a=a)).scalar()
+    return None if v is None else float(v)
 
-def insert_gasto(data):
-    cols = ", ".join(data.keys())
-    vals = ", ".join([f":{k}" for k in data.keys()])
+gastos_t = table("gastos", column("username"), column("data"), column("valor"),
+                 column("descricao"), column("categoria"), column("fonte"))
+
+def insert_gastos(rows):
     with eng.begin() as c:
-        c.execute(text(f"INSERT INTO gastos ({cols}) VALUES ({vals})"), data)
+        c.execute(insert(gastos_t), rows)
 
 def upsert_orc(u, m, a, v):
     with eng.begin() as c:
         c.execute(text(
             "INSERT INTO orcamento (username,mes,ano,valor_planejado) "
             "VALUES (:u,:m,:a,:v) ON CONFLICT (username,mes,ano) DO UPDATE "
-            "SET valor_planejado=:v"
+            "SET valor_planejado=excluded.valor_planejado"
         ), dict(u=u, m=m, a=a, v=v))
 
-# Load data
-gastos_df = load_table("gastos")
-orc_df = load_table("orcamento")
+def delete_gastos(u, ids):
+    with eng.begin() as c:
+        c.execute(text("DELETE FROM gastos WHERE id = ANY(:ids) AND username = :u"), dict(ids=ids, u=u))
 
 # Month/Year selector
 meses = ["Janeiro","Fevereiro","Março","Abril","Maio","Junho",
@@ -99,56 +145,64 @@ mes = st.sidebar.selectbox("Mês", range(1,13), format_func=lambda x: meses[x-1]
                             index=date.today().month-1)
 ano = st.sidebar.number_input("Ano", value=date.today().year, step=1, format="%d")
 
+# Load data
+sel, agg = month_slice(user, mes, ano)
+orc_val = load_orc(user, mes, ano)
+
 # Budget
-row = orc_df[(orc_df.username==user)&(orc_df.mes==mes)&(orc_df.ano==ano)]
-orc_val = float(row.valor_planejado.iloc[0]) if not row.empty else None
 st.sidebar.markdown(f"**Orçamento:** {brl(orc_val) if orc_val else '–'}")
 novo = st.sidebar.number_input("Definir orçamento", value=orc_val or 0.0, step=0.01, format="%.2f")
 if st.sidebar.button("Salvar orçamento"):
     upsert_orc(user, mes, ano, novo)
     st.sidebar.success("Orçamento salvo!")
-    load_table.clear()
+    load_orc.clear(user, mes, ano)
     rerun()
 if orc_val is None:
     st.warning("Defina o orçamento antes."); st.stop()
 st.sidebar.divider()
 
 # New expense form
-st.sidebar.header("Novo gasto")
-first = date(ano, mes, 1); last = date(ano, mes, monthrange(ano,mes)[1])
-default = date.today() if first<=date.today()<=last else first
-d = st.sidebar.date_input("Data", value=default, min_value=first, max_value=last, format="DD/MM/YYYY")
-desc = st.sidebar.text_input("Descrição")
-cats = ["Alimentação","Transporte","Lazer","Fixos","Educação","Presentes","Comprinhas","Outros"]
-cat = st.sidebar.selectbox("Categoria", cats)
-fonte = st.sidebar.selectbox("Fonte", ["Dinheiro","Crédito","Débito","PIX","Vale Refeição","Vale Alimentação"])
-parc = st.sidebar.checkbox("Compra parcelada?")
-if parc:
-    n = st.sidebar.number_input("Qtde parcelas",1,step=1,value=2)
-    modo = st.sidebar.radio("Informar:",["Total","Parcela"],horizontal=True)
-    if modo=="Total":
-        vt = st.sidebar.number_input("Total R$",0.0,step=0.01,format="%.2f"); vp = vt/n
+@st.fragment
+def novo_gasto(ano, mes):
+    st.header("Novo gasto")
+    first, last = month_bounds(ano, mes)
+    default = date.today() if first<=date.today()<=last else first
+    d = st.date_input("Data", value=default, min_value=first, max_value=last, format="DD/MM/YYYY")
+    desc = st.text_input("Descrição")
+    cats = ["Alimentação","Transporte","Lazer","Fixos","Educação","Presentes","Comprinhas","Outros"]
+    cat = st.selectbox("Categoria", cats)
+    fonte = st.selectbox("Fonte", ["Dinheiro","Crédito","Débito","PIX","Vale Refeição","Vale Alimentação"])
+    parc = st.checkbox("Compra parcelada?")
+    if parc:
+        n = st.number_input("Qtde parcelas",1,step=1,value=2)
+        modo = st.radio("Informar:",["Total","Parcela"],horizontal=True)
+        if modo=="Total":
+            vt = st.number_input("Total R$",0.0,step=0.01,format="%.2f"); vp = vt/n
+        else:
+            vp = st.number_input("Parcela R$",0.0,step=0.01,format="%.2f"); vt = vp*n
+        st.markdown(f"Total: {brl(vt)} → Parcela: {brl(vp)}")
     else:
-        vp = st.sidebar.number_input("Parcela R$",0.0,step=0.01,format="%.2f"); vt = vp*n
-    st.sidebar.markdown(f"Total: {brl(vt)} → Parcela: {brl(vp)}")
-else:
-    vp = st.sidebar.number_input("Valor R$",0.0,step=0.01,format="%.2f"); vt=vp; n=1
-if st.sidebar.button("Registrar"):
-    for i in range(int(n)):
-        insert_gasto({"username":user, "data":add_months(d,i), "valor":vp,
-                      "descricao":f"{desc} ({i+1}/{int(n)})", "categoria":cat, "fonte":fonte})
-    st.sidebar.success("Gasto salvo!")
-    load_table.clear()
-    rerun()
+        vp = st.number_input("Valor R$",0.0,step=0.01,format="%.2f"); vt=vp; n=1
+    if st.button("Registrar"):
+        novas = [{"username":user, "data":add_months(d,i), "valor":vp,
+                  "descricao":f"{desc} ({i+1}/{int(n)})", "categoria":cat, "fonte":fonte}
+                 for i in range(int(n))]
+        insert_gastos(novas)
+        st.success("Gasto salvo!")
+        for m, a in {(r["data"].month, r["data"].year) for r in novas}:
+            month_slice.clear(user, m, a)
+        rerun()
+
+with st.sidebar:
+    novo_gasto(ano, mes)
 
 # Dashboard summary & charts
-df = gastos_df[gastos_df.username==user].copy()
-df["data"] = pd.to_datetime(df.data)
-sel = df[(df.data.dt.month==mes)&(df.data.dt.year==ano)]
-gt = sel.valor.sum(); sd = orc_val - gt
+gt_cents = int(agg[(agg.gc==1)&(agg.gf==1)].valor_cents.sum())
+sd_cents = round(orc_val*100) - gt_cents
+gt, sd = gt_cents/100, sd_cents/100
 c1,c2,c3 = st.columns(3)
 c1.metric("💸 Gasto", brl(gt)); c2.metric("🎯 Orçamento", brl(orc_val))
-c3.metric("📈 Saldo", brl(sd), delta=brl(sd), delta_color="normal" if sd>=0 else "inverse")
+c3.metric("📈 Saldo", brl(sd), delta=f"{sd:+,.2f}".translate(_TR), delta_color="normal")
 st.title(f"Gastos de {meses[mes-1]}/{ano}")
 if sel.empty:
     st.info("Nenhum gasto."); st.stop()
@@ -162,22 +216,27 @@ cor_ft = {"Dinheiro":"#1f77b4","Crédito":"#d62728","Débito":"#2ca02c",
 cor_sd = {"Gasto":"#e74c3c","Disponível":"#2ecc71"}
 
 def make_donut(df, field, title, palette, legend_title):
-    df_f = df[df["valor"]>0]
-    present = df_f[field].tolist()
+    df_f = df.loc[df["valor_cents"]>0, [field, "valor_cents"]]
+    keys = set(df_f[field].unique())
+    present = [k for k in palette if k in keys]
     return alt.Chart(df_f).mark_arc(innerRadius=60).encode(
-        theta="valor:Q",
+        theta="valor_cents:Q",
         color=alt.Color(f"{field}:N", title=legend_title,
                         scale=alt.Scale(domain=present, range=[palette[k] for k in present]),
                         legend=alt.Legend(orient="left"))
     ).properties(title=title)
 
-df_cat = sel.groupby("categoria")["valor"].sum().reset_index()
-df_ft = sel.groupby("fonte")["valor"].sum().reset_index()
-df_sd = pd.DataFrame({"Status":["Gasto","Disponível"],"valor":[gt,max(sd,0)]})
+@st.cache_data(ttl=60)
+def build_charts(agg, gt_cents, sd_cents):
+    df_cat = agg[(agg.gc==0)&(agg.gf==1)][["categoria","valor_cents"]]
+    df_ft = agg[(agg.gc==1)&(agg.gf==0)][["fonte","valor_cents"]]
+    df_sd = pd.DataFrame({"Status":["Gasto","Disponível"],
+                          "valor_cents":[gt_cents, max(sd_cents, 0)]})
+    return (make_donut(df_cat, "categoria", "Por categoria", cor_cat, "Categoria"),
+            make_donut(df_ft, "fonte", "Por fonte", cor_ft, "Fonte"),
+            make_donut(df_sd, "Status", "Disponibilidade", cor_sd, "Disponibilidade"))
 
-chart1 = make_donut(df_cat, "categoria", "Por categoria", cor_cat, "Categoria")
-chart2 = make_donut(df_ft, "fonte", "Por fonte", cor_ft, "Fonte")
-chart3 = make_donut(df_sd, "Status", "Disponibilidade", cor_sd, "Disponibilidade")
+chart1, chart2, chart3 = build_charts(agg, gt_cents, sd_cents)
 
 d1,d2,d3 = st.columns(3)
 d1.altair_chart(chart1, use_container_width=True)
@@ -186,27 +245,33 @@ d3.altair_chart(chart3, use_container_width=True)
 
 # Detailed list with deletion
 st.subheader("📜 Registros detalhados")
-if "del_id" not in st.session_state:
-    st.session_state.del_id = None
-
-for _, r in sel.sort_values("data", ascending=False).iterrows():
-    cols = st.columns([1.2,3,2,1.2,1.2,0.6])
-    cols[0].write(r.data.strftime("%d/%m/%Y"))
-    cols[1].write(r.descricao)
-    cols[2].write(r.categoria)
-    cols[3].write(r.fonte)
-    cols[4].write(brl(r.valor))
-    if cols[5].button("🗑️", key=f"del{r.id}"):
-        st.session_state.del_id = r.id
-    if st.session_state.del_id == r.id:
-        st.warning(f"Apagar {r.descricao} ({r.data.strftime('%d/%m/%Y')}, {brl(r.valor)})?")
+
+@st.fragment
+def render_detail(sel):
+    view = sel.assign(
+        data=lambda x: x["data"].dt.strftime("%d/%m/%Y"),
+        valor=lambda x: brl_series(x["valor"]),
+    )[["data","descricao","categoria","fonte","valor"]]
+    with st.form("del_form", border=False):
+        ev = st.dataframe(view, hide_index=True, use_container_width=True,
+                          on_select="rerun", selection_mode="multi-row")
+        apagar = st.form_submit_button("🗑️ Apagar selecionados")
+    if "del_ids" not in st.session_state:
+        st.session_state.del_ids = []
+    if apagar:
+        st.session_state.del_ids = sel.id.iloc[ev.selection.rows].tolist()
+    shown = set(sel.id.tolist())
+    ids = [i for i in st.session_state.del_ids if i in shown]
+    if ids:
+        st.warning(f"Apagar {len(ids)} registro(s) selecionado(s)?")
         ok, no = st.columns(2)
-        if ok.button("✅", key=f"ok{r.id}"):
-            with eng.begin() as conn:
-                conn.execute(text("DELETE FROM gastos WHERE id = :id"), {"id": r.id})
-            load_table.clear()
-            st.session_state.del_id = None
-            rerun()
-        if no.button("❌", key=f"no{r.id}"):
-            st.session_state.del_id = None
+        if ok.button("✅", key="del_ok"):
+            delete_gastos(user, ids)
+            month_slice.clear(user, mes, ano)
+            st.session_state.del_ids = []
             rerun()
+        if no.button("❌", key="del_no"):
+            st.session_state.del_ids = []
+            st.rerun(scope="fragment")
+
+render_detail(sel)